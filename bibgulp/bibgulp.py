@@ -28,17 +28,21 @@ See readme for details.
 """
 
 import argparse
+import functools
 import os
 import re
 import subprocess
 import textwrap
 import time
 import unicodedata
-from typing import Union
+from typing import Dict, List, Optional, Union
 
 from bibtexparser import customization as czn
+from bibtexparser.bibdatabase import STANDARD_TYPES
 from bibtexparser.bparser import BibTexParser
 from bibtexparser.latexenc import string_to_latex
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 
 def main():
@@ -53,21 +57,33 @@ def main():
 
 
 _stop_words = "a an the on is it at of in as to are there el la has"
-stop_words = set(_stop_words.split())
+stop_words = frozenset(_stop_words.split())
 field_order = """author title year journal volume number pages
                  editor booktitle series keywords""".split()
-known_fields = set(field_order + ["ENTRYTYPE", "ID", "abstract"])
-capitalizers = {"Science", "Geology", "Surveys in Geophysics", "Radiocarbon"}
+known_fields = frozenset(field_order + ["ENTRYTYPE", "ID", "abstract"])
+capitalizers = frozenset({"Science", "Geology", "Surveys in Geophysics",
+                          "Radiocarbon"})
+
+_PAGES_RE = re.compile(r"(\d+)\D+(\d+)")
+_DOI_RE = re.compile(r"^https?://(dx\.)?doi\.org/")
+_BRACE_ESC_RE = re.compile(r"\\[{}]")
+_SKIP_RE = re.compile(r"[.](pdf|part|crdownload)$", re.IGNORECASE)
+_KW_TRANS = str.maketrans({",": ";"})
+_string_to_latex_cached = functools.lru_cache(maxsize=2048)(string_to_latex)
+_ENTRY_START_RE = re.compile(r"\s*@(\w+)\s*\{\s*([^\s,{}=]+)\s*,")
+_FIELD_NAME_RE = re.compile(r"\s*([\w:-]+)\s*=\s*")
+_NUMBER_RE = re.compile(r"\d+")
+_WRAPPER = textwrap.TextWrapper(width=78,
+                                initial_indent="  ",
+                                subsequent_indent="    ")
 
 
 def get_first_word(record):
     if "title" not in record:
         return
-    title = record["title"]
-    words = [w.lower() for w in title.split()]
-    for word in words:
-        if word not in stop_words and \
-           not re.match(r"\d", word):
+    for word in record["title"].split():
+        word = word.lower()
+        if word not in stop_words and not word[:1].isdigit():
             return word
     return "xxx"
 
@@ -76,7 +92,7 @@ def fix_pages(record):
     if "pages" not in record:
         return
     p0 = record["pages"]
-    matches = re.search(r"(\d+)\D+(\d+)", p0)
+    matches = _PAGES_RE.search(p0)
     if matches:
         record["pages"] = "%s--%s" % (matches.group(1), matches.group(2))
 
@@ -92,7 +108,7 @@ def fix_title(record):
         if len(word0) > 1 and word0[0].isupper() and word0[1:].islower():
             # title case
             word1 = "{"+word0[0]+"}"+word0[1:]
-        elif word0.islower() or not re.match(r"[a-zA-Z]", word0):
+        elif word0.islower() or not word0[:1].isalpha():
             # all lowercase, or no alphabetic characters
             word1 = word0
         else:  # mixed case or all upper case
@@ -103,14 +119,13 @@ def fix_title(record):
 
 def print_field(output, key, value):
     line = "%s = {%s}," % (key, value)
-    wrapper = textwrap.TextWrapper(width=78,
-                                   initial_indent="  ",
-                                   subsequent_indent="    ")
-    lines = wrapper.wrap(line)
-    output += lines
+    output.extend(_WRAPPER.wrap(line))
 
 
+@functools.lru_cache(maxsize=4096)
 def strip_accents(s: str) -> str:
+    if s.isascii():
+        return s
     return "".join(c for c in unicodedata.normalize('NFD', s)
                    if unicodedata.category(c) != 'Mn')
 
@@ -136,10 +151,9 @@ def clean_record(record):
         record["keywords"] = record["keyword"]
         del record["keyword"]
     if "keywords" in record:
-        kw = record["keywords"]
-        kw = kw.lower()
+        kw = record["keywords"].lower()
         if "," in kw and ";" not in kw:
-            kw = kw.replace(",", ";")
+            kw = kw.translate(_KW_TRANS)
         if ";" in kw and "; " not in kw:
             kw = kw.replace(";", "; ")
         record["keywords"] = kw
@@ -149,64 +163,185 @@ def clean_record(record):
         record["year"] = "XXXX"
     if "number" in record:
         record["number"] = record["number"].replace("–", "--")
-    authorkey = strip_accents(record["author"][0].split(",")[0].lower())
+    surname = record["author"][0].split(",")[0].lower()
+    authorkey = surname if surname.isascii() else strip_accents(surname)
     output = ["@%s{%s%s%s," % (record["ENTRYTYPE"], authorkey, record["year"],
                                get_first_word(record))]
     record["author"] = " and ".join(record["author"])
-    record["author"] = string_to_latex(record["author"])
+    record["author"] = _string_to_latex_cached(record["author"])
     fix_title(record)
     if "doi" in record:
         # Elsevier don't know the difference between a DOI and a URL.
         # record["doi"] = record["doi"].replace("http://dx.doi.org/", "")
-        record["doi"] = re.sub("^https?://(dx.)?doi.org/", "", record["doi"])
+        if record["doi"].startswith("http"):
+            record["doi"] = _DOI_RE.sub("", record["doi"])
     for field in field_order:
         if field in record:
             print_field(output, field, record[field])
-    for key, value in record.items():
-        if key not in known_fields:
-            print_field(output, key, value)
+    for key in sorted(record.keys() - known_fields):
+        print_field(output, key, record[key])
 
     # Elsevier like to throw in some backslashes and curly brackets.
-    record["abstract"] = \
-        record["abstract"].replace(r"\{", "").replace(r"\}", "")
+    record["abstract"] = _BRACE_ESC_RE.sub("", record["abstract"])
 
     if "url" in record and "sciencedirect" in record["url"]:
         # Elsevier append the word "Abstract" to the start of the abstract.
-        record["abstract"] = re.sub("^Abstract ", "", record["abstract"])
+        record["abstract"] = record["abstract"].removeprefix("Abstract ")
     print_field(output, "abstract", record["abstract"])
     output[-1] = output[-1][:-1]  # strip trailing comma
     output.append("}")
     return "\n".join(output)+"\n\n"
 
 
+def decode_bytes(contents: bytes) -> str:
+    try:
+        return contents.decode('utf-8')
+    except UnicodeDecodeError:
+        # Only pay for chardet's detection when the input isn't UTF-8.
+        import chardet
+        encoding = chardet.detect(contents)["encoding"] or "latin-1"
+        return contents.decode(encoding, errors="replace")
+
+
+def _strip_after_newlines(value: str) -> str:
+    # Mimic BibTexParser, which strips leading whitespace from all but the
+    # first line of a value.
+    lines = value.splitlines()
+    if len(lines) > 1:
+        lines = [lines[0]] + [line.lstrip() for line in lines[1:]]
+    return "\n".join(lines)
+
+
+def _fast_parse(text: str) -> Optional[List[Dict[str, str]]]:
+    """Parse a single plain BibTeX entry without invoking BibTexParser.
+
+    Only handles the common case of one entry with braced, quoted, or
+    numeric field values. Returns None for anything else (string macros,
+    concatenation, multiple entries, ...), in which case the caller should
+    fall back to BibTexParser.
+    """
+    text = text.expandtabs()  # as BibTexParser (via pyparsing) does
+    lowered = text.lower()
+    if "@string" in lowered or "@preamble" in lowered:
+        return None
+    match = _ENTRY_START_RE.match(text)
+    if not match or match.group(1).lower() not in STANDARD_TYPES:
+        return None
+    entry_type, id_ = match.group(1).lower(), match.group(2)
+    record = {}
+    pos = match.end()
+    length = len(text)
+    while True:
+        while pos < length and text[pos].isspace():
+            pos += 1
+        if pos < length and text[pos] == "}":
+            if text[pos + 1:].strip():
+                return None  # something after the entry
+            break
+        match = _FIELD_NAME_RE.match(text, pos)
+        if not match:
+            return None
+        key = match.group(1).lower()
+        if key in record:
+            return None
+        pos = match.end()
+        if pos >= length:
+            return None
+        if text[pos] in "{\"":
+            closer = "}" if text[pos] == "{" else '"'
+            depth = 0
+            start = pos + 1
+            pos = start
+            while pos < length:
+                char = text[pos]
+                if char == closer and depth == 0:
+                    break
+                if char == "{":
+                    depth += 1
+                elif char == "}":
+                    depth -= 1
+                    if depth < 0:
+                        return None
+                pos += 1
+            else:
+                return None  # unterminated value
+            value = _strip_after_newlines(text[start:pos])
+            pos += 1
+        else:
+            match = _NUMBER_RE.match(text, pos)
+            if not match:
+                return None  # probably a string macro
+            value = match.group()
+            pos = match.end()
+        record[key] = value
+        while pos < length and text[pos].isspace():
+            pos += 1
+        if pos < length and text[pos] == ",":
+            pos += 1
+        elif pos >= length or text[pos] != "}":
+            return None
+    record["ENTRYTYPE"] = entry_type
+    record["ID"] = id_
+    return [record]
+
+
 def parse_bibtex(contents: Union[str, bytes]) -> None:
-    # common_strings: see
-    # https://bibtexparser.readthedocs.io/en/master/bibtexparser.html#module-bibtexparser.bparser
-    # and https://github.com/sciunto-org/python-bibtexparser/issues/248 .
-    parser = BibTexParser(common_strings=True)
     contents_str = \
-        contents if type(contents) == str else contents.decode('utf-8')
-    database = parser.parse(contents_str + "\n")
-    for record in database.entries:
+        contents if type(contents) == str else decode_bytes(contents)
+    entries = _fast_parse(contents_str)
+    if entries is None:
+        # common_strings: see
+        # https://bibtexparser.readthedocs.io/en/master/bibtexparser.html#module-bibtexparser.bparser
+        # and https://github.com/sciunto-org/python-bibtexparser/issues/248 .
+        parser = BibTexParser(common_strings=True)
+        entries = parser.parse(contents_str + "\n").entries
+    outputs = []
+    for record in entries:
         output = clean_record(record)
         print(output)
-        to_clipboard(output)
+        outputs.append(output)
+    if outputs:
+        to_clipboard("".join(outputs))
+
+
+def ris_to_bibtex(filename: str) -> Optional[bytes]:
+    # Errors are reported rather than raised, so that a missing or failing
+    # converter doesn't stop watch_dir.
+    try:
+        ris2xml = subprocess.Popen(["ris2xml", filename],
+                                   stdout=subprocess.PIPE)
+    except OSError as error:
+        print("Can't run ris2xml: %s" % error)
+        return None
+    try:
+        xml2bib = subprocess.Popen(["xml2bib"], stdin=ris2xml.stdout,
+                                   stdout=subprocess.PIPE)
+    except OSError as error:
+        print("Can't run xml2bib: %s" % error)
+        ris2xml.kill()
+        ris2xml.stdout.close()
+        ris2xml.wait()
+        return None
+    ris2xml.stdout.close()  # so ris2xml gets SIGPIPE if xml2bib exits
+    bibtex, _ = xml2bib.communicate()
+    ris2xml.wait()
+    for process in ris2xml, xml2bib:
+        if process.returncode != 0:
+            print("%s failed with exit status %d" %
+                  (process.args[0], process.returncode))
+            return None
+    return bibtex
 
 
 def parse_file(filename: str) -> None:
-    ris = False
-    with open(filename, "r") as bibfile:
-        for i in range(10):
-            line = bibfile.readline()
-            if line.startswith("TY  - "):
-                ris = True
-    if ris:
-        process = subprocess.run(
-            ["ris2xml \"%s\" | xml2bib" % filename],
-            shell=True, capture_output=True)
-        parse_bibtex(process.stdout)
-    else:
-        with open(filename, "r") as bibfile:
+    with open(filename, "rb") as bibfile:
+        head = bibfile.peek(512)[:512]
+        ris = head.startswith(b"TY  - ") or b"\nTY  - " in head
+        if ris:
+            bibtex = ris_to_bibtex(filename)
+            if bibtex is not None:
+                parse_bibtex(bibtex)
+        else:
             parse_bibtex(bibfile.read())
 
 
@@ -216,19 +351,49 @@ def to_clipboard(text: str) -> None:
         p.communicate(input=bytes(text, "UTF-8"))
 
 
-def watch_dir(dirname: str) -> None:
-    contents_prev = set(os.listdir(dirname))
-    while True:
-        time.sleep(0.2)
-        contents = set(os.listdir(dirname))
-        contents_new = contents - contents_prev
+class _NewFileHandler(FileSystemEventHandler):
+
+    # A download can produce both a creation and a rename event for the same
+    # path; ignore repeats within this many seconds.
+    REPEAT_INTERVAL = 5.0
+
+    def __init__(self):
+        super().__init__()
+        self._last_parsed = {}
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._parse_new_file(event.src_path)
+
+    def on_moved(self, event):
+        # Browsers download to a temporary file and rename it when complete.
+        if not event.is_directory:
+            self._parse_new_file(event.dest_path)
+
+    def _parse_new_file(self, path: str) -> None:
+        leafname = os.path.basename(path)
+        if _SKIP_RE.search(leafname):
+            return
         time.sleep(0.3)  # let partial files finish downloading
-        for leafname in contents_new:
-            if re.search(r"[.](pdf|part|crdownload)$", leafname, re.IGNORECASE):
-                continue
-            print("Parsing: ", leafname)
-            parse_file(os.path.join(dirname, leafname))
-        contents_prev = contents
+        try:
+            if os.path.getsize(path) == 0:
+                return  # placeholder; the real contents arrive by rename
+        except OSError:
+            return  # already gone
+        now = time.monotonic()
+        last = self._last_parsed.get(path)
+        if last is not None and now - last < self.REPEAT_INTERVAL:
+            return
+        self._last_parsed[path] = now
+        print("Parsing: ", leafname)
+        parse_file(path)
+
+
+def watch_dir(dirname: str) -> None:
+    observer = Observer()
+    observer.schedule(_NewFileHandler(), dirname, recursive=False)
+    observer.start()
+    observer.join()
 
 
 if __name__ == "__main__":